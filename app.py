@@ -1,14 +1,23 @@
 import logging
 import os
 import json
-import requests
+import re
+import aiohttp
 import gspread
 import asyncio
-from oauth2client.service_account import ServiceAccountCredentials
+import time
+import math
+import sqlite3
+import hashlib
+import threading
+from array import array
+from google.oauth2.service_account import Credentials
 from datetime import datetime
+from cachetools import TTLCache
+from tenacity import retry, retry_if_exception, stop_after_attempt, stop_after_delay, wait_exponential_jitter
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, MessageHandler, filters, ContextTypes
-from flask import Flask, request
+from quart import Quart, request
 
 # --- Konfigurasi Logging ---
 logging.basicConfig(
@@ -17,8 +26,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# --- Inisialisasi Flask App ---
-app = Flask(__name__)
+# --- Inisialisasi Quart App (ASGI, satu event loop untuk semua request) ---
+app = Quart(__name__)
 
 # --- Memuat Konfigurasi dari Environment Variables ---
 try:
@@ -30,51 +39,447 @@ try:
     LOG_SHEET_NAME = os.environ['LOG_SHEET_NAME']
     GOOGLE_CREDENTIALS_JSON = os.environ['GOOGLE_CREDENTIALS_JSON']
 except KeyError as e:
-    logger.error(f"Environment variable {e} tidak ditemukan!")
+    logger.error("Environment variable %s tidak ditemukan!", e)
     exit()
 
+# --- Kredensial & Client Google Sheets (dibuat sekali saat import, token di-refresh otomatis) ---
+SCOPES = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
+          "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
+try:
+    GOOGLE_CREDENTIALS = Credentials.from_service_account_info(json.loads(GOOGLE_CREDENTIALS_JSON), scopes=SCOPES)
+    GSPREAD_CLIENT = gspread.authorize(GOOGLE_CREDENTIALS)
+except (ValueError, KeyError) as e:
+    logger.error("GOOGLE_CREDENTIALS_JSON tidak valid: %s", e)
+    GSPREAD_CLIENT = None
+
+# --- Konfigurasi Opsional: Semantic Cache Chatbot (nonaktif jika EMBEDDING_API kosong) ---
+EMBEDDING_API = os.environ.get('EMBEDDING_API')
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'nomic-embed-text')
+SEMANTIC_CACHE_DB = os.environ.get('SEMANTIC_CACHE_DB', '/tmp/chatbot_cache.sqlite3')
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', '0.92'))
+SEMANTIC_CACHE_TTL = 6 * 60 * 60
+SEMANTIC_CACHE_MAX_SCAN = 500
+EMBEDDING_TIMEOUT = 2
+
+# --- Konfigurasi Opsional: Redis untuk State Pengguna (dipakai jika REDIS_URL diisi) ---
+REDIS_URL = os.environ.get('REDIS_URL')
+USER_STATE_TTL = 3600
+
+# --- Pola Parsing Pesan Order ---
+# Kata kunci boleh diapit teks lain sebelum ':' (mis. "Nama Lengkap:", "No Resi:", "- Nama:"), seperti parser lama.
+_ORDER_RE = re.compile(r'(?im)^[^:\n]*?(nama|kode[ \t]*barang|alamat|resi)[^:\n]*:[ \t]*(\S.*?)[ \t]*$')
+_WHITESPACE_RE = re.compile(r'[ \t]+')
+_ORDER_KEY_MAP = {'nama': 'nama', 'kode barang': 'kodeBarang', 'kodebarang': 'kodeBarang', 'alamat': 'alamat', 'resi': 'resi'}
+
 # --- State Management ---
-user_states = {}
+class MemoryUserStates:
+    """user_states di memori proses, dibatasi jumlah dan umurnya dengan TTLCache."""
 
-# --- Inisialisasi Aplikasi Bot ---
-application = Application.builder().token(TELEGRAM_TOKEN).build()
+    def __init__(self, maxsize: int, ttl: int):
+        self._states = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, chat_id) -> str or None:
+        return self._states.get(chat_id)
+
+    async def set(self, chat_id, selection: str):
+        self._states[chat_id] = selection
+
+    async def delete(self, chat_id) -> bool:
+        return self._states.pop(chat_id, None) is not None
+
+class RedisUserStates:
+    """Menyimpan user_states di Redis (klien asyncio) agar state tetap ada antar cold start serverless.
+
+    Jika Redis tidak bisa dihubungi, error dicatat dan state sementara disimpan di memori proses
+    supaya handler tetap bisa membalas.
+    """
+
+    def __init__(self, url: str, ttl: int):
+        import redis.asyncio as redis
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._redis_error = redis.RedisError
+        self._ttl = ttl
+        self._fallback = MemoryUserStates(100_000, ttl)
+
+    async def get(self, chat_id) -> str or None:
+        try:
+            return await self._redis.get(f"state:{chat_id}")
+        except self._redis_error as e:
+            logger.error("Gagal membaca state dari Redis: %s", e)
+            return await self._fallback.get(chat_id)
+
+    async def set(self, chat_id, selection: str):
+        try:
+            await self._redis.setex(f"state:{chat_id}", self._ttl, selection)
+        except self._redis_error as e:
+            logger.error("Gagal menyimpan state ke Redis: %s", e)
+            await self._fallback.set(chat_id, selection)
+
+    async def delete(self, chat_id) -> bool:
+        deleted = await self._fallback.delete(chat_id)
+        try:
+            return await self._redis.delete(f"state:{chat_id}") > 0 or deleted
+        except self._redis_error as e:
+            logger.error("Gagal menghapus state di Redis: %s", e)
+            return deleted
+
+user_states = RedisUserStates(REDIS_URL, USER_STATE_TTL) if REDIS_URL else MemoryUserStates(100_000, USER_STATE_TTL)
+
+# --- Cache Koneksi Google Sheets (sekali otorisasi per proses) ---
+_SPREADSHEET = None
+_SPREADSHEET_LOCK = asyncio.Lock()
+_WORKSHEETS: dict[str, gspread.Worksheet] = {}
+
+# --- Cache Data Order (snapshot per kolom + index resi -> posisi baris) ---
+RESI_TTL = 60
+ORDER_FIELDS = ('resi', 'id_order', 'tanggal_order', 'nama', 'kode_barang', 'alamat', 'status_pengiriman')
+ORDER_COLS: dict[str, list] = {field: [] for field in ORDER_FIELDS}
+RESI_INDEX: dict[str, int] = {}
+RESI_MISSES: set = set()
+RESI_INDEX_TS = 0.0
+RESI_INDEX_LOCK = asyncio.Lock()
+ORDER_HEADERS = None
+RESI_COL = None
+
+# --- Counter Baris Order (menghindari get_all_values() tiap insert, disinkronkan dari updatedRange) ---
+NEXT_ROW = None
+_UPDATED_RANGE_RE = re.compile(r'![A-Z]+(\d+)(?::[A-Z]+(\d+))?$')
+
+# --- Penulisan Sheet Berkelompok (baris dari request yang bersamaan digabung jadi satu append_rows) ---
+WRITE_BATCH_SIZE = 50
+_PENDING_ROWS: dict[str, list] = {}
+_WRITERS_ACTIVE: set = set()
 
+# --- HTTP Session (dipakai bersama untuk semua request ke chatbot API) ---
+HTTP_SESSION = None
+
+# --- Koneksi SQLite untuk Semantic Cache (diakses dari worker thread) ---
+_CACHE_DB = None
+_CACHE_DB_LOCK = threading.Lock()
+
+# --- Exact-Match Cache Jawaban Chatbot (di depan semantic cache) ---
+EXACT_CACHE_TTL = 6 * 60 * 60
+CHATBOT_EXACT_CACHE = TTLCache(maxsize=10_000, ttl=EXACT_CACHE_TTL)
+
+
+# --- Teks & Keyboard Statis (dibuat sekali saat import) ---
+WELCOME_TEXT = "Selamat datang! Silakan pilih layanan yang Anda butuhkan:"
+_MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("1. Chatbot Product Knowledge", callback_data="chatbot_product")],
+    [InlineKeyboardButton("2. Chatbot Ticket Alignment", callback_data="chatbot_ticket")],
+    [InlineKeyboardButton("3. Tiket (Input & Cek Resi)", callback_data="ticket_system")],
+])
+_MODE_REPLIES = {
+    'chatbot_product': "Anda sekarang dalam mode <b>Chatbot Product Knowledge</b>.\n\nSilakan ajukan pertanyaan Anda. Kirim /stop untuk keluar.",
+    'chatbot_ticket': "Anda sekarang dalam mode <b>Chatbot Ticket Alignment</b>.\n\nSilakan ajukan pertanyaan Anda. Kirim /stop untuk keluar.",
+    'ticket_system': "Anda sekarang dalam mode <b>Tiket</b>.\n\nKirim <code>cari [nomor resi]</code> untuk mencari data atau kirim data dengan format yang ditentukan. Kirim /stop untuk keluar.",
+}
+TICKET_HELP_TEXT = ("Perintah tidak dikenali dalam mode Tiket.\n\n"
+                    "Gunakan format:\n- <code>cari [nomor resi]</code>\n"
+                    "- atau kirim data order lengkap.\n\n"
+                    "Kirim /stop untuk keluar dari mode ini.")
 
 # =================================================================
 # FUNGSI PEMBANTU UNTUK KONEKSI GOOGLE SHEETS
 # =================================================================
 
-def get_sheets_connection():
-    """Membuat koneksi ke Google Sheets. Dipanggil hanya saat dibutuhkan."""
+def _is_retryable_sheets_error(e: BaseException) -> bool:
+    """Hanya rate limit (429) dan error server (5xx) yang layak dicoba ulang."""
+    if not isinstance(e, gspread.exceptions.APIError): return False
+    status_code = e.response.status_code
+    return status_code == 429 or status_code >= 500
+
+def _is_rate_limit_error(e: BaseException) -> bool:
+    """429 berarti request ditolak sebelum diproses, jadi aman dicoba ulang walau tidak idempoten."""
+    return isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 429
+
+# Total waktu tunggu dibatasi agar retry tetap muat dalam batas waktu fungsi serverless.
+_SHEETS_RETRY_WAIT = wait_exponential_jitter(initial=0.5, max=4)
+_SHEETS_RETRY_STOP = stop_after_attempt(4) | stop_after_delay(8)
+
+@retry(retry=retry_if_exception(_is_retryable_sheets_error), wait=_SHEETS_RETRY_WAIT,
+       stop=_SHEETS_RETRY_STOP, reraise=True)
+async def _sheets_call(fn, *args, **kwargs):
+    """Menjalankan panggilan gspread (I/O jaringan yang blocking) di thread terpisah agar event loop tidak tertahan."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+@retry(retry=retry_if_exception(_is_rate_limit_error), wait=_SHEETS_RETRY_WAIT,
+       stop=_SHEETS_RETRY_STOP, reraise=True)
+async def _sheets_append(fn, *args, **kwargs):
+    """Seperti _sheets_call, tetapi untuk penulisan yang tidak idempoten (append_rows): 5xx tidak dicoba ulang
+    karena datanya bisa saja sudah tertulis."""
+    return await asyncio.to_thread(fn, *args, **kwargs)
+
+async def get_sheets_connection():
+    """Mengembalikan handle spreadsheet yang di-cache. Spreadsheet hanya dibuka pada pemanggilan pertama."""
+    global _SPREADSHEET
+    if _SPREADSHEET is not None:
+        return _SPREADSHEET
+    async with _SPREADSHEET_LOCK:
+        if _SPREADSHEET is None:
+            if not GSPREAD_CLIENT: return None
+            try:
+                _SPREADSHEET = await _sheets_call(GSPREAD_CLIENT.open, SPREADSHEET_NAME)
+            except Exception as e:
+                logger.error("Gagal membuat koneksi ke Google Sheets: %s", e)
+                return None
+    return _SPREADSHEET
+
+async def get_worksheet(name: str) -> gspread.Worksheet or None:
+    """Mengembalikan handle worksheet yang di-cache agar worksheet() tidak dipanggil ulang tiap request."""
+    if name in _WORKSHEETS:
+        return _WORKSHEETS[name]
+    spreadsheet = await get_sheets_connection()
+    if not spreadsheet: return None
+    _WORKSHEETS[name] = await _sheets_call(spreadsheet.worksheet, name)
+    return _WORKSHEETS[name]
+
+def reset_sheets_connection_on_auth_error(e: Exception):
+    """Membuang handle yang di-cache jika Google menolak token (401) agar spreadsheet dibuka ulang."""
+    global _SPREADSHEET
+    if isinstance(e, gspread.exceptions.APIError) and e.response.status_code == 401:
+        _SPREADSHEET = None
+        _WORKSHEETS.clear()
+
+async def post_init(application: Application) -> None:
+    """Membuka ClientSession bersama sekali untuk seluruh umur event loop."""
+    global HTTP_SESSION
+    if HTTP_SESSION is None or HTTP_SESSION.closed:
+        HTTP_SESSION = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=30),
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300)
+        )
+
+async def post_shutdown(application: Application) -> None:
+    if HTTP_SESSION is not None and not HTTP_SESSION.closed:
+        await HTTP_SESSION.close()
+
+def _number_order_rows(rows: list, first_row_num: int):
+    for offset, row in enumerate(rows):
+        row[0] = first_row_num + offset
+        row[1] = f"ORD-{row[0]}"
+
+async def _write_order_rows(worksheet: gspread.Worksheet, rows: list):
+    """Memberi nomor & ID order pada batch lalu menulisnya.
+
+    Posisi baris yang sebenarnya dibaca dari updatedRange respons append. Jika instance lain sudah
+    menulis lebih dulu, ID dikoreksi agar tetap unik dan counter lokal ikut disinkronkan.
+    """
+    global NEXT_ROW
+    if NEXT_ROW is None:
+        NEXT_ROW = len(await _sheets_call(worksheet.get_all_values))
+    _number_order_rows(rows, NEXT_ROW)
+    response = await _sheets_append(worksheet.append_rows, rows, value_input_option='RAW')
+    # Sejak titik ini baris sudah tersimpan: kegagalan koreksi ID hanya dicatat, tidak menggagalkan batch.
+    try:
+        match = _UPDATED_RANGE_RE.search(response['updates']['updatedRange'])
+        start_row = int(match.group(1))
+        end_row = int(match.group(2) or start_row)
+    except (KeyError, TypeError, AttributeError) as e:
+        logger.error("Gagal membaca updatedRange dari respons append: %s", e)
+        NEXT_ROW = None
+        return
+    NEXT_ROW = end_row
+    if start_row - 1 != rows[0][0]:
+        corrected = [[start_row - 1 + offset, f"ORD-{start_row - 1 + offset}"] for offset in range(len(rows))]
+        try:
+            await _sheets_call(worksheet.update, range_name=f"A{start_row}:B{end_row}",
+                               values=corrected, value_input_option='RAW')
+        except Exception as e:
+            reset_sheets_connection_on_auth_error(e)
+            logger.error("Gagal mengoreksi ID order baris %d-%d (tertulis sebagai %s): %s",
+                         start_row, end_row, [row[1] for row in rows], e)
+            return
+        for row, (row_num, id_order) in zip(rows, corrected):
+            row[0], row[1] = row_num, id_order
+
+async def _write_batch(sheet_name: str, batch: list):
+    rows = [row for row, _ in batch]
     try:
-        scope = ["https://spreadsheets.google.com/feeds", 'https://www.googleapis.com/auth/spreadsheets',
-                 "https://www.googleapis.com/auth/drive.file", "https://www.googleapis.com/auth/drive"]
-        creds_dict = json.loads(GOOGLE_CREDENTIALS_JSON)
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        spreadsheet = client.open(SPREADSHEET_NAME)
-        return spreadsheet
+        worksheet = await get_worksheet(sheet_name)
+        if not worksheet: raise ConnectionError("koneksi Google Sheets tidak tersedia")
+        if sheet_name == ORDER_SHEET_NAME:
+            await _write_order_rows(worksheet, rows)
+        else:
+            await _sheets_append(worksheet.append_rows, rows, value_input_option='RAW')
     except Exception as e:
-        logger.error(f"Gagal membuat koneksi ke Google Sheets: {e}")
+        reset_sheets_connection_on_auth_error(e)
+        for _, future in batch:
+            if not future.done(): future.set_exception(e)
+    else:
+        for row, future in batch:
+            if not future.done(): future.set_result(row)
+
+async def append_row_batched(sheet_name: str, row: list) -> list:
+    """Menulis satu baris dan menunggu sampai tersimpan.
+
+    Request pertama menjadi penulis; baris dari request lain yang masuk selama penulisan berjalan
+    dikumpulkan dan ditulis bersama pada append_rows berikutnya. Tidak ada jeda tambahan yang ditunggu,
+    jadi penggabungan hanya terjadi saat ada beberapa update yang diproses bersamaan.
+    """
+    future = asyncio.get_running_loop().create_future()
+    pending = _PENDING_ROWS.setdefault(sheet_name, [])
+    pending.append((row, future))
+    if sheet_name not in _WRITERS_ACTIVE:
+        _WRITERS_ACTIVE.add(sheet_name)
+        try:
+            while pending:
+                batch = pending[:WRITE_BATCH_SIZE]
+                del pending[:WRITE_BATCH_SIZE]
+                # shield: batch yang sedang ditulis tetap diselesaikan walau request penulisnya dibatalkan.
+                await asyncio.shield(_write_batch(sheet_name, batch))
+        finally:
+            _WRITERS_ACTIVE.discard(sheet_name)
+            for _, waiting in pending:
+                if not waiting.done(): waiting.set_exception(ConnectionError("penulisan sheet dibatalkan"))
+            pending.clear()
+    return await future
+
+async def get_resi_index() -> dict or None:
+    """Mengembalikan index {resi: posisi baris di ORDER_COLS}. Sheet hanya dibaca ulang jika cache sudah kedaluwarsa."""
+    global ORDER_COLS, RESI_INDEX, RESI_INDEX_TS, ORDER_HEADERS, RESI_COL
+    if time.time() - RESI_INDEX_TS <= RESI_TTL:
+        return RESI_INDEX
+    async with RESI_INDEX_LOCK:
+        if time.time() - RESI_INDEX_TS > RESI_TTL:
+            order_sheet = await get_worksheet(ORDER_SHEET_NAME)
+            if not order_sheet: return None
+            headers, *rows = await _sheets_call(order_sheet.get_all_values) or [[]]
+            pos = {header: j for j, header in enumerate(headers)}
+            ORDER_COLS = {field: [row[pos[field]] for row in rows] if field in pos else ['N/A'] * len(rows)
+                          for field in ORDER_FIELDS}
+            ORDER_COLS['tanggal_order'] = [_format_order_date(raw) for raw in ORDER_COLS['tanggal_order']]
+            RESI_INDEX = {resi.lower(): i for i, resi in enumerate(ORDER_COLS['resi'])}
+            RESI_MISSES.clear()
+            RESI_INDEX_TS = time.time()
+            ORDER_HEADERS = headers
+            if 'resi' in pos: RESI_COL = pos['resi'] + 1
+    return RESI_INDEX
+
+def _format_order_date(raw) -> str:
+    """Mengubah '2024-01-31 10:00:00' menjadi '31 Jan 2024'. Nilai lain dikembalikan apa adanya."""
+    try:
+        return datetime.strptime(raw.split(" ", 1)[0], '%Y-%m-%d').strftime('%d %b %Y')
+    except (ValueError, TypeError, AttributeError):
+        return raw
+
+def _cache_order_row(row: dict):
+    """Menambahkan (atau menimpa) satu baris order ke snapshot kolom. Tanggal disimpan sudah diformat."""
+    row = {**row, 'tanggal_order': _format_order_date(row.get('tanggal_order', 'N/A'))}
+    resi_key = str(row.get('resi', '')).lower()
+    RESI_MISSES.discard(resi_key)
+    i = RESI_INDEX.get(resi_key)
+    if i is None:
+        for field in ORDER_FIELDS:
+            ORDER_COLS[field].append(row.get(field, 'N/A'))
+        RESI_INDEX[resi_key] = len(ORDER_COLS['resi']) - 1
+    else:
+        for field in ORDER_FIELDS:
+            ORDER_COLS[field][i] = row.get(field, 'N/A')
+
+async def find_order_row(resi: str) -> dict or None:
+    """Mencari resi yang belum ada di snapshot dengan membaca kolom resi saja, lalu mengambil satu baris yang cocok.
+
+    Resi yang tidak ditemukan dicatat di RESI_MISSES sampai snapshot berikutnya dimuat, jadi pencarian
+    ulang resi yang sama tidak memanggil API lagi.
+    """
+    global ORDER_HEADERS, RESI_COL
+    resi_key = resi.lower()
+    if resi_key in RESI_MISSES: return None
+    order_sheet = await get_worksheet(ORDER_SHEET_NAME)
+    if not order_sheet: return None
+    if RESI_COL is None:
+        ORDER_HEADERS = await _sheets_call(order_sheet.row_values, 1)
+        RESI_COL = ORDER_HEADERS.index('resi') + 1
+    resi_column = await _sheets_call(order_sheet.col_values, RESI_COL)
+    row_num = next((j + 1 for j, value in enumerate(resi_column) if j and value.lower() == resi_key), None)
+    if row_num is None:
+        RESI_MISSES.add(resi_key)
+        return None
+    return dict(zip(ORDER_HEADERS, await _sheets_call(order_sheet.row_values, row_num)))
+
+# =================================================================
+# FUNGSI PEMBANTU UNTUK SEMANTIC CACHE CHATBOT
+# =================================================================
+
+def _cache_scope(api_url: str, chat_id: int) -> str:
+    """Namespace cache jawaban. Jawaban ticket alignment bisa bergantung pada user_id, jadi dipisah per chat."""
+    return api_url if api_url == CHATBOT_PRODUCT_API else f"{api_url}|{chat_id}"
+
+def _exact_cache_key(scope: str, question: str) -> str:
+    return hashlib.sha256(f"{scope}|{question.strip().lower()}".encode()).hexdigest()
+
+def _get_cache_db() -> sqlite3.Connection:
+    global _CACHE_DB
+    if _CACHE_DB is None:
+        _CACHE_DB = sqlite3.connect(SEMANTIC_CACHE_DB, check_same_thread=False)
+        _CACHE_DB.execute("CREATE TABLE IF NOT EXISTS chatbot_cache (emb BLOB, scope TEXT, answer TEXT, ts REAL)")
+        _CACHE_DB.execute("CREATE INDEX IF NOT EXISTS chatbot_cache_scope_ts ON chatbot_cache (scope, ts)")
+    return _CACHE_DB
+
+async def embed(text: str) -> list or None:
+    """Mengambil embedding (sudah dinormalisasi) dari EMBEDDING_API. None jika cache nonaktif atau gagal."""
+    if not EMBEDDING_API: return None
+    try:
+        payload = {"model": EMBEDDING_MODEL, "prompt": text}
+        # Timeout pendek: jika embedding lambat, langsung lanjut ke chatbot API tanpa cache.
+        timeout = aiohttp.ClientTimeout(total=EMBEDDING_TIMEOUT)
+        async with HTTP_SESSION.post(EMBEDDING_API, json=payload, timeout=timeout) as response:
+            response.raise_for_status()
+            response_json = await response.json(content_type=None)
+        vector = response_json.get("embedding") or (response_json.get("embeddings") or [None])[0]
+        norm = math.sqrt(sum(x * x for x in vector))
+        return [x / norm for x in vector] if norm else None
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, TypeError) as e:
+        logger.error("Error saat akses embedding API %s: %s", EMBEDDING_API, e)
+        return None
+
+def vec_search(scope: str, emb: list, threshold: float = SEMANTIC_CACHE_THRESHOLD) -> str or None:
+    """Mencari jawaban tersimpan dalam scope yang sama dengan cosine similarity >= threshold.
+
+    Blocking (sqlite + perkalian vektor), jadi dipanggil lewat asyncio.to_thread. Hanya
+    SEMANTIC_CACHE_MAX_SCAN entri terbaru yang dibandingkan.
+    """
+    try:
+        with _CACHE_DB_LOCK:
+            rows = _get_cache_db().execute(
+                "SELECT emb, answer FROM chatbot_cache WHERE scope = ? AND ts > ? ORDER BY ts DESC LIMIT ?",
+                (scope, time.time() - SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_SCAN)
+            ).fetchall()
+    except sqlite3.Error as e:
+        logger.error("Error saat membaca semantic cache: %s", e)
         return None
+    best_score, best_answer = threshold, None
+    for blob, answer in rows:
+        cached = array('f')
+        cached.frombytes(blob)
+        if len(cached) != len(emb): continue
+        score = sum(a * b for a, b in zip(emb, cached))
+        if score >= best_score:
+            best_score, best_answer = score, answer
+    return best_answer
+
+def vec_insert(scope: str, emb: list, answer: str):
+    try:
+        with _CACHE_DB_LOCK:
+            db = _get_cache_db()
+            with db:
+                db.execute("DELETE FROM chatbot_cache WHERE ts <= ?", (time.time() - SEMANTIC_CACHE_TTL,))
+                db.execute("INSERT INTO chatbot_cache (emb, scope, answer, ts) VALUES (?, ?, ?, ?)",
+                           (array('f', emb).tobytes(), scope, answer, time.time()))
+    except sqlite3.Error as e:
+        logger.error("Error saat menulis semantic cache: %s", e)
 
 # =================================================================
 # FUNGSI-FUNGSI UTAMA HANDLER
 # =================================================================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    keyboard = [
-        [InlineKeyboardButton("1. Chatbot Product Knowledge", callback_data="chatbot_product")],
-        [InlineKeyboardButton("2. Chatbot Ticket Alignment", callback_data="chatbot_ticket")],
-        [InlineKeyboardButton("3. Tiket (Input & Cek Resi)", callback_data="ticket_system")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Selamat datang! Silakan pilih layanan yang Anda butuhkan:", reply_markup=reply_markup)
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=_MAIN_MENU)
 
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    if chat_id in user_states:
-        del user_states[chat_id]
+    if await user_states.delete(chat_id):
         await update.message.reply_text("Anda telah keluar dari mode saat ini. Kirim /start untuk memulai lagi.")
     else:
         await update.message.reply_text("Anda sedang tidak dalam mode apa pun. Kirim /start untuk memulai.")
@@ -84,22 +489,16 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await query.answer()
     chat_id = query.message.chat_id
     selection = query.data
-    user_states[chat_id] = selection
+    await user_states.set(chat_id, selection)
     mode_text = selection.replace("_", " ").title()
     await query.edit_message_text(text=f"Pilihan Anda: {mode_text}")
-    reply_text = ""
-    if selection == 'chatbot_product':
-      reply_text = "Anda sekarang dalam mode <b>Chatbot Product Knowledge</b>.\n\nSilakan ajukan pertanyaan Anda. Kirim /stop untuk keluar."
-    elif selection == 'chatbot_ticket':
-      reply_text = "Anda sekarang dalam mode <b>Chatbot Ticket Alignment</b>.\n\nSilakan ajukan pertanyaan Anda. Kirim /stop untuk keluar."
-    elif selection == 'ticket_system':
-      reply_text = "Anda sekarang dalam mode <b>Tiket</b>.\n\nKirim <code>cari [nomor resi]</code> untuk mencari data atau kirim data dengan format yang ditentukan. Kirim /stop untuk keluar."
+    reply_text = _MODE_REPLIES.get(selection, "")
     if reply_text:
         await context.bot.send_message(chat_id=chat_id, text=reply_text, parse_mode='HTML')
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    mode = user_states.get(chat_id)
+    mode = await user_states.get(chat_id)
     if mode == 'chatbot_product':
         await handle_chatbot(update, context, CHATBOT_PRODUCT_API)
     elif mode == 'chatbot_ticket':
@@ -112,129 +511,155 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 async def handle_chatbot(update: Update, context: ContextTypes.DEFAULT_TYPE, api_url: str):
     question = update.message.text
     chat_id = update.effective_chat.id
+    scope = _cache_scope(api_url, chat_id)
+    cache_key = _exact_cache_key(scope, question)
+    cached_reply = CHATBOT_EXACT_CACHE.get(cache_key)
+    if cached_reply:
+        await update.message.reply_text(cached_reply)
+        return
     await context.bot.send_chat_action(chat_id=chat_id, action='typing')
+    emb = await embed(question)
+    cached_reply = await asyncio.to_thread(vec_search, scope, emb) if emb else None
+    if cached_reply:
+        await update.message.reply_text(cached_reply)
+        return
     try:
         payload = {"question": question, "user_id": str(chat_id)}
-        response = requests.post(api_url, json=payload, timeout=30)
-        response.raise_for_status()
-        response_json = response.json()
-        reply = response_json.get("result") or response_json.get("message") or response_json.get("answer", "Maaf, chatbot tidak dapat merespons saat ini.")
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error saat akses chatbot API {api_url}: {e}")
+        async with HTTP_SESSION.post(api_url, json=payload) as response:
+            response.raise_for_status()
+            response_json = await response.json(content_type=None)
+        answer = response_json.get("result") or response_json.get("message") or response_json.get("answer")
+        reply = answer or "Maaf, chatbot tidak dapat merespons saat ini."
+        if answer:
+            CHATBOT_EXACT_CACHE[cache_key] = answer
+        if answer and emb:
+            await asyncio.to_thread(vec_insert, scope, emb, answer)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        logger.error("Error saat akses chatbot API %s: %s", api_url, e)
         reply = f"⚠ Terjadi kesalahan saat mengakses chatbot."
     await update.message.reply_text(reply)
 
 async def handle_ticket_system(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = update.message.text
-    text_lower = message_text.lower()
     reply_text = ""
-    if text_lower.startswith('cari '):
+    if message_text[:5].lower() == 'cari ':
         resi = message_text[5:].strip()
         reply_text = await cek_resi_sheets(resi)
-    elif 'nama:' in text_lower and 'kode barang:' in text_lower:
+    else:
         parsed_data = parse_order_message(message_text)
         if parsed_data:
             parsed_data['chatId'] = update.effective_chat.id
             id_order = await input_data_sheets(parsed_data)
             reply_text = f"Data berhasil disimpan dengan ID Order <b>{id_order}</b>" if id_order else "Data gagal disimpan."
-        else:
+        elif _ORDER_RE.search(message_text):
             reply_text = "Format data yang Anda kirim tidak lengkap atau salah. Data tidak dapat disimpan."
-    else:
-        reply_text = ("Perintah tidak dikenali dalam mode Tiket.\n\n"
-                      "Gunakan format:\n- <code>cari [nomor resi]</code>\n"
-                      "- atau kirim data order lengkap.\n\n"
-                      "Kirim /stop untuk keluar dari mode ini.")
+        else:
+            reply_text = TICKET_HELP_TEXT
     await update.message.reply_html(reply_text)
 
 def parse_order_message(message: str) -> dict or None:
-    data = {}
-    for line in message.split('\n'):
-        parts = line.split(':', 1)
-        if len(parts) == 2:
-            key = parts[0].strip().lower()
-            value = parts[1].strip()
-            if 'nama' in key: data['nama'] = value
-            if 'kode barang' in key: data['kodeBarang'] = value
-            if 'alamat' in key: data['alamat'] = value
-            if 'resi' in key: data['resi'] = value
+    data = {_ORDER_KEY_MAP[_WHITESPACE_RE.sub(' ', m.group(1).lower())]: m.group(2).strip()
+            for m in _ORDER_RE.finditer(message)}
     return data if all(k in data for k in ['nama', 'kodeBarang', 'alamat', 'resi']) else None
 
 async def cek_resi_sheets(resi: str) -> str:
     if not resi:
         return "Format pencarian tidak valid. Gunakan: <code>cari [nomor resi]</code>"
     try:
-        spreadsheet = get_sheets_connection()
-        if not spreadsheet: return "Gagal terhubung ke database Google Sheets."
-        order_sheet = spreadsheet.worksheet(ORDER_SHEET_NAME)
-        all_data = order_sheet.get_all_records()
-        found_data = None
-        for row in all_data:
-            if str(row.get('resi')).lower() == resi.lower():
-                found_data = row
-                break
-        if found_data:
-            try:
-                order_date = datetime.strptime(found_data.get('tanggal_order', '').split(" ")[0], '%Y-%m-%d').strftime('%d %b %Y')
-            except (ValueError, TypeError):
-                order_date = found_data.get('tanggal_order', 'N/A')
+        if await get_resi_index() is None: return "Gagal terhubung ke database Google Sheets."
+        i = RESI_INDEX.get(resi.lower())
+        if i is None:
+            found_data = await find_order_row(resi)
+            if found_data:
+                _cache_order_row(found_data)
+                i = RESI_INDEX.get(resi.lower())
+        if i is not None:
+            cols = ORDER_COLS
             return (f"Info Resi <b>{resi}</b>\n\n"
-                    f"ID Order: {found_data.get('id_order', 'N/A')}\n"
-                    f"Tanggal Order: {order_date}\n"
-                    f"Nama: {found_data.get('nama', 'N/A')}\n"
-                    f"Kode Barang: {found_data.get('kode_barang', 'N/A')}\n"
-                    f"Alamat: {found_data.get('alamat', 'N/A')}\n"
-                    f"Status Pengiriman: <b>{found_data.get('status_pengiriman', 'N/A')}</b>")
+                    f"ID Order: {cols['id_order'][i]}\n"
+                    f"Tanggal Order: {cols['tanggal_order'][i]}\n"
+                    f"Nama: {cols['nama'][i]}\n"
+                    f"Kode Barang: {cols['kode_barang'][i]}\n"
+                    f"Alamat: {cols['alamat'][i]}\n"
+                    f"Status Pengiriman: <b>{cols['status_pengiriman'][i]}</b>")
         else:
             return f"Resi <b>{resi}</b> tidak ditemukan."
     except Exception as e:
-        logger.error(f"Error di cek_resi_sheets: {e}")
+        reset_sheets_connection_on_auth_error(e)
+        logger.error("Error di cek_resi_sheets: %s", e)
         await log_to_sheet(f"Error di cek_resi_sheets: {e}")
         return f"Terjadi kesalahan saat mencari resi {resi}."
 
 async def input_data_sheets(data: dict) -> str or None:
     try:
-        spreadsheet = get_sheets_connection()
-        if not spreadsheet: return None
-        order_sheet = spreadsheet.worksheet(ORDER_SHEET_NAME)
-        last_row_num = len(order_sheet.get_all_values())
-        id_order = f"ORD-{last_row_num}"
         today = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        # Nomor baris & ID order diisi saat batch ditulis (lihat _write_order_rows).
         new_row = [
-            last_row_num, id_order, today, data['nama'], data['kodeBarang'],
+            None, None, today, data['nama'], data['kodeBarang'],
             data['alamat'], data['resi'], 'Sedang dikemas', data['chatId']
         ]
-        order_sheet.append_row(new_row)
+        id_order = (await append_row_batched(ORDER_SHEET_NAME, new_row))[1]
+        if RESI_INDEX_TS:
+            _cache_order_row({
+                'resi': data['resi'], 'id_order': id_order, 'tanggal_order': today, 'nama': data['nama'],
+                'kode_barang': data['kodeBarang'], 'alamat': data['alamat'], 'status_pengiriman': 'Sedang dikemas'
+            })
         return id_order
     except Exception as e:
-        logger.error(f"Error di input_data_sheets: {e}")
+        reset_sheets_connection_on_auth_error(e)
+        logger.error("Error di input_data_sheets: %s", e)
         await log_to_sheet(f"Error di input_data_sheets: {e}")
         return None
 
 async def log_to_sheet(log_message: str):
     try:
-        spreadsheet = get_sheets_connection()
-        if not spreadsheet: return
-        log_sheet = spreadsheet.worksheet(LOG_SHEET_NAME)
         today = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_sheet.append_row([today, log_message])
+        await append_row_batched(LOG_SHEET_NAME, [today, log_message])
     except Exception as e:
-        logger.error(f"Gagal menulis log ke sheet: {e}")
+        logger.error("Gagal menulis log ke sheet: %s", e)
 
 # =================================================================
 # BAGIAN VERCEL DEPLOYMENT
 # =================================================================
 
+# --- Inisialisasi Aplikasi Bot ---
+application = Application.builder().token(TELEGRAM_TOKEN).post_init(post_init).post_shutdown(post_shutdown).build()
+
 application.add_handler(CommandHandler("start", start))
 application.add_handler(CommandHandler("stop", stop))
 application.add_handler(CallbackQueryHandler(button_click))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-@app.route('/api', methods=['POST'])
-def webhook():
-    update = Update.de_json(request.get_json(force=True), application.bot)
-    asyncio.run(application.process_update(update))
+_BOT_STARTED = False
+_BOT_START_LOCK = asyncio.Lock()
+
+async def start_bot():
+    """Inisialisasi bot sekali per proses. Aman dipanggil berulang kali."""
+    global _BOT_STARTED
+    async with _BOT_START_LOCK:
+        if not _BOT_STARTED:
+            await application.initialize()
+            await post_init(application)
+            _BOT_STARTED = True
+
+@app.before_serving
+async def startup():
+    await start_bot()
+
+@app.after_serving
+async def shutdown():
+    if _BOT_STARTED:
+        await application.shutdown()
+        await post_shutdown(application)
+
+@app.post('/api')
+async def webhook():
+    # Runtime serverless tidak selalu mengirim event lifespan, jadi pastikan bot sudah diinisialisasi.
+    await start_bot()
+    update = Update.de_json(await request.get_json(force=True), application.bot)
+    await application.process_update(update)
     return 'ok'
 
 @app.route('/')
-def index():
+async def index():
     return 'Bot is running!'